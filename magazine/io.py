@@ -1,5 +1,7 @@
 import sys
 import os
+import json
+import tempfile
 from os.path import dirname, realpath
 
 from neatlogger import log
@@ -34,6 +36,66 @@ def assert_directory(path):
             log.error("Folders {} cannot be created: {}", folder, e)
 
 
+def get_cache_directory():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "magazine")
+
+
+def read_json(file, default=None):
+    if not os.path.isfile(file):
+        return default
+    try:
+        with open(file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        log.warning("Cannot read file {}: {}", file, e)
+        return default
+
+
+def write_json(file, data):
+    # Write to a temporary file first and replace the target atomically,
+    # so that an interrupted write never leaves a corrupted file behind.
+    assert_directory(file)
+    tmpfile = None
+    try:
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(file) or ".")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmpfile, file)
+    except Exception as e:
+        log.warning("Cannot write file {}: {}", file, e)
+        if tmpfile is not None and os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+
+def write_temp_image(buffer):
+    # SVG needs the proper file extension to be recognized by fpdf,
+    # raster formats are detected from their content.
+    # The buffer is written without copying and released afterwards,
+    # so that the caller can keep using (and resizing) it.
+    file = None
+    try:
+        with buffer.getbuffer() as data:
+            head = bytes(data[:64]).lstrip()
+            suffix = ".svg" if head.startswith((b"<?xml", b"<svg")) else ".png"
+            with tempfile.NamedTemporaryFile(
+                prefix="magazine-", suffix=suffix, delete=False
+            ) as f:
+                file = f.name
+                f.write(data)
+    except OSError as e:
+        log.warning("Cannot write figure to a temporary file: {}", e)
+        if file is not None:
+            try:
+                os.unlink(file)
+            except OSError:
+                pass
+        return None
+    return file
+
+
 @log.catch
 def get_script_directory():
     if getattr(sys, "frozen", False):
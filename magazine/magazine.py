@@ -1,28 +1,96 @@
+import atexit
+import inspect
 import io
+import os
 import sys
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import re
-from functools import wraps
+import string
+from functools import partial, wraps
+from math import nan
 from textwrap import dedent
 
 from neatlogger import log
 
+from magazine.io import get_cache_directory, read_json, write_json, write_temp_image
 
-class SafeDict(dict):
+_DOI_RE = re.compile(r"^10[.][0-9]{4,}")
+_REPORT_RE = re.compile(r"Report\s+\-+\n(.*?)(?:\n\n|\Z)", re.DOTALL)
+_REFS_RE = re.compile(r"References\s+\-+\n(.*?)(?:\n\n|\Z)", re.DOTALL)
+_FORMATTER = string.Formatter()
+
+# Full citation texts from CrossRef, persisted across runs
+_CITATION_CACHE_FILE = os.path.join(get_cache_directory(), "doi_citations.json")
+_citation_cache = None
+
+
+def _get_citation_cache() -> dict:
+    """Loads the DOI citation cache from disk on first use."""
+    global _citation_cache
+    if _citation_cache is None:
+        data = read_json(_CITATION_CACHE_FILE, default={})
+        _citation_cache = data if isinstance(data, dict) else {}
+    return _citation_cache
+
+
+def _fetch_citation(cn, doi: str):
+    """Downloads the full citation text of a single DOI from CrossRef."""
+    try:
+        return cn.content_negotiation(ids=doi, format="text")
+    except Exception as e:
+        log.warning("Cannot retrieve citation for {}: {}", doi, e)
+        return None
+
+
+def _compile_template(text: str) -> list:
     """
-    A variant of dict that does not raise an error for missing keys.
-    Thanks to: https://stackoverflow.com/a/17215533/2575273
+    Splits a format string into its literal text and replacement fields.
+    The result can be rendered repeatedly with _render_template().
 
     Example
     -------
-    >>> parameters = SafeDict(a=1, b=2)
-    ... print(parameters["a"], parameters["c"])
-    1 {c}
+    >>> _compile_template("a={a:.1f}, b={b}")
+    [('a=', 'a', '.1f', None), (', b=', 'b', '', None)]
 
     """
+    return list(_FORMATTER.parse(text))
+
+
+def _render_template(segments: list, parameters: dict) -> str:
+    """
+    Fills a compiled template with parameters.
+    Fields without a matching parameter are kept as they are.
+
+    Example
+    -------
+    >>> _render_template(_compile_template("a={a:.1f}, c={c}"), dict(a=1))
+    'a=1.0, c={c}'
 
-    def __missing__(self, key):
-        return "{" + key + "}"
+    """
+    out = []
+    for literal, field, spec, conversion in segments:
+        out.append(literal)
+        if field is None:
+            continue
+        try:
+            value, _ = _FORMATTER.get_field(field, (), parameters)
+        except (KeyError, AttributeError, IndexError):
+            # Keep the placeholder for missing parameters
+            out.append(
+                "{"
+                + field
+                + ("!" + conversion if conversion else "")
+                + (":" + spec if spec else "")
+                + "}"
+            )
+            continue
+        if conversion:
+            value = _FORMATTER.convert_field(value, conversion)
+        if "{" in spec:
+            # Nested fields in the format spec, e.g. {x:{width}}
+            spec = _render_template(_compile_template(spec), parameters)
+        out.append(format(value, spec))
+    return "".join(out)
 
 
 class Magazine:
@@ -44,8 +112,9 @@ class Magazine:
     topics = dict()
     figures = dict()
     references = []
-    dois = []
+    dois = dict()  # used as an ordered set
     active = False
+    _posted = dict()  # cache of posted texts per topic
 
     def __init__(self):
         pass
@@ -93,7 +162,8 @@ class Magazine:
         topic: str
             Name of an existing or new topic
         message: str | io.BytesIO
-            Text or bytes object (to store figures)
+            Text or bytes object (to store figures).
+            Figures are written to a temporary file, see figure().
         *values
             Any number of values to be inserted into the formatted message
 
@@ -110,15 +180,18 @@ class Magazine:
         if isinstance(message, str):
             # normal text
             if values:
-                # Replace all None by np.nan to avoid NoneType Error on formatting
-                values = [np.nan if v is None else v for v in values]
+                # Replace all None by nan to avoid NoneType Error on formatting
+                values = [nan if v is None else v for v in values]
                 message = message.format(*values)
 
             Magazine.topics[topic].append(message)
+            Magazine._posted.pop(topic, None)
 
         elif isinstance(message, io.BytesIO):
-            # figure object
-            Magazine.figures[topic].append(message)
+            # figure object, kept on disk to save memory
+            file = write_temp_image(message)
+            if file is not None:
+                Magazine.figures[topic].append(file)
 
         else:
             log.warning("Nothing to report: message is neither text nor image.")
@@ -143,11 +216,9 @@ class Magazine:
         if not Magazine.active:
             return
 
-        doi_pattern = r"^10[.][0-9]{4,}"
-
         for ref in refs:
-            if re.search(doi_pattern, ref):
-                Magazine.dois.append(ref)
+            if _DOI_RE.match(ref):
+                Magazine.dois[ref] = None
             else:
                 Magazine.references.append(ref)
 
@@ -172,12 +243,15 @@ class Magazine:
         """
         # if isinstance(topic, str):
         #     topic = [ topic ]
-        text = []
+        texts = []
         for topic in topics:
             Magazine.assert_topic(topic)
-            text.append(" ".join(Magazine.topics[topic]))
+            # Reuse the text from a previous post unless the topic has changed
+            if topic not in Magazine._posted:
+                Magazine._posted[topic] = " ".join(Magazine.topics[topic])
+            texts.append(Magazine._posted[topic])
 
-        return " ".join(text)
+        return " ".join(texts)
 
     @staticmethod
     def figure(*topics) -> list:
@@ -192,7 +266,8 @@ class Magazine:
         Returns
         -------
         list
-            Merged topic figures.
+            Merged topic figures, as paths to temporary image files.
+            The files are deleted by Magazine.clean().
 
         Examples
         --------
@@ -204,8 +279,7 @@ class Magazine:
         figures = []
         for topic in topics:
             Magazine.assert_topic(topic)
-            for figure in Magazine.figures[topic]:
-                figures.append(figure)
+            figures.extend(Magazine.figures[topic])
 
         return figures
 
@@ -213,7 +287,8 @@ class Magazine:
     def collect_references() -> list:
         """
         Lists all items in Magazine.references.
-        Downloads the full reference text for all items in Magazine.dois
+        Downloads the full reference text for all items in Magazine.dois,
+        unless it has been downloaded in a previous run already.
 
         Returns
         -------
@@ -226,19 +301,35 @@ class Magazine:
         ...     print(item)
 
         """
-        reflist = Magazine.references
+        # Work on a copy, so that repeated calls do not pile up citations
+        reflist = list(Magazine.references)
 
         if len(Magazine.dois) > 0:
-
-            Magazine.dois = list(set(Magazine.dois))  # remove duplicates
-            log.progress("Collecting {} citations from CrossRef...", len(Magazine.dois))
-            from habanero import cn
-
-            reflist2 = cn.content_negotiation(ids=Magazine.dois, format="text")
-            if isinstance(reflist2, str):
-                reflist2 = [reflist2]
-            reflist2 = [ref.rstrip() for ref in reflist2 if ref is not None]
-            reflist += reflist2
+            citations = _get_citation_cache()
+            missing = [doi for doi in Magazine.dois if doi not in citations]
+
+            if missing:
+                log.progress("Collecting {} citations from CrossRef...", len(missing))
+                from habanero import cn
+
+                # Requests are I/O-bound, so download them concurrently
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    reflist2 = list(executor.map(partial(_fetch_citation, cn), missing))
+                n_failed = 0
+                for doi, ref in zip(missing, reflist2):
+                    if ref is None:
+                        n_failed += 1
+                    else:
+                        citations[doi] = ref.rstrip()
+                if n_failed:
+                    log.warning(
+                        "{} of {} citations could not be retrieved from CrossRef.",
+                        n_failed,
+                        len(missing),
+                    )
+                write_json(_CITATION_CACHE_FILE, citations)
+
+            reflist.extend(citations[doi] for doi in Magazine.dois if doi in citations)
 
         reflist.sort()
         return reflist
@@ -248,14 +339,28 @@ class Magazine:
         """
         Cleans topics, figures, references, and dois to make space for a new Magazine.
         """
+        Magazine.remove_figure_files()
         Magazine.topics = dict()
         Magazine.figures = dict()
         Magazine.references = []
-        Magazine.dois = []
+        Magazine.dois = dict()
+        Magazine._posted = dict()
         return
 
     new = clean
 
+    @staticmethod
+    def remove_figure_files():
+        """
+        Deletes the temporary files in which reported figures are stored.
+        """
+        for files in Magazine.figures.values():
+            for file in files:
+                try:
+                    os.unlink(file)
+                except OSError:
+                    pass
+
     class reporting:
         def __init__(
             self,
@@ -270,23 +375,44 @@ class Magazine:
 
             """
             self.topic = topic
-            self.parameters = SafeDict()
 
         def __call__(self, func):
+            # The parsed docstring belongs to this function, not to the decorator
+            # instance, which may be shared by several functions. It is parsed
+            # on the first call while Magazine is active.
+            parsed = None
+            # The locals live in the innermost function of stacked decorators
+            code = getattr(inspect.unwrap(func), "__code__", None)
+
             @wraps(func)
             def wrapper(*args, **kwargs):
+                nonlocal parsed
 
                 if not Magazine.active:
-                    result = func(*args, **kwargs)
-                    return result
+                    # No bookkeeping at all while reporting is turned off
+                    return func(*args, **kwargs)
+
+                if parsed is None:
+                    parsed = (
+                        self._split_docstring(func.__doc__, func.__name__)
+                        if func.__doc__
+                        else ()
+                    )
 
                 local_vars = {}
 
-                def trace_calls(frame, event, arg):
+                def trace_locals(frame, event, arg):
                     if event == "return":
                         # Capture locals when function is returning
                         local_vars.update(frame.f_locals)
-                    return trace_calls
+
+                def trace_calls(frame, event, arg):
+                    # Only trace the decorated function itself, not its callees.
+                    # Without a code object to compare with, all frames are traced.
+                    if code is not None and frame.f_code is not code:
+                        return None
+                    frame.f_trace_lines = False
+                    return trace_locals
 
                 # Set up the trace
                 old_trace = sys.gettrace()
@@ -297,54 +423,76 @@ class Magazine:
                 finally:
                     sys.settrace(old_trace)
 
-                self.parameters.update(
-                    {
-                        "function": func.__name__,
-                        "return": result,
-                    }
-                )
-
-                for key, val in local_vars.items():
-                    self.parameters[key] = val
+                # Fresh parameters per call, so that concurrent or repeated
+                # calls do not share variables.
+                parameters = {"function": func.__name__, "return": result}
+                parameters.update(local_vars)
 
-                self._parse_docstring(func.__doc__)
+                self._parse_docstring(parsed, parameters)
                 return result
 
             return wrapper
 
-        def _parse_docstring(self, docstring):
-            """Parses the docstring for Report and References sections."""
-
-            if docstring:
-                # Report
-                # ------
-                report_pattern = r"Report\s+\-+\n(.*?)(?:\n\n|\Z)"
-                report_match = re.search(report_pattern, docstring, re.DOTALL)
-                if report_match:
-                    report_text = report_match.group(1)
-                    report_text = report_text.format_map(self.parameters)
-                    report_text = dedent(report_text)
-                    # remove single newlines
-                    report_text = re.sub(r"(?<!\n)\n(?!\n)", " ", report_text)
-                    Magazine.report(self.topic, report_text)
-
-                # References
-                # ----------
-                refs_pattern = r"References\s+\-+\n(.*?)(?:\n\n|\Z)"
-                refs_match = re.search(refs_pattern, docstring, re.DOTALL)
-                if refs_match:
-                    refs_text = refs_match.group(1)
-                    refs_text = dedent(refs_text)
-                    # Create list from lines
-                    refs_list = refs_text.split("\n")
+        def _parse_docstring(self, parsed, parameters):
+            """Reports the parsed Report and References sections of the docstring."""
+
+            if parsed:
+                report_template, refs_list = parsed
+
+                if report_template is not None:
+                    Magazine.report(
+                        self.topic, _render_template(report_template, parameters)
+                    )
+
+                if refs_list is not None:
                     Magazine.cite(*refs_list)
 
             else:
                 log.warning(
                     "No docstring provided for function {}.",
-                    self.parameters["function"],
+                    parameters["function"],
                 )
 
+        @staticmethod
+        def _split_docstring(docstring, name):
+            """
+            Extracts the Report template and the References list from a docstring.
+            The name of the function is only used for warnings.
+
+            Returns
+            -------
+            tuple
+                Compiled Report template and list of references, None if not found.
+            """
+            report_template = None
+            refs_list = None
+
+            # Report
+            # ------
+            report_match = _REPORT_RE.search(docstring)
+            if report_match:
+                report_text = dedent(report_match.group(1))
+                # remove single newlines
+                report_text = "\n\n".join(
+                    part.replace("\n", " ") for part in report_text.split("\n\n")
+                )
+                try:
+                    report_template = _compile_template(report_text)
+                except ValueError as e:
+                    log.warning(
+                        "Cannot read the Report section of function {}: {}", name, e
+                    )
+
+            # References
+            # ----------
+            refs_match = _REFS_RE.search(docstring)
+            if refs_match:
+                refs_text = dedent(refs_match.group(1))
+                # Create list from lines
+                refs_list = refs_text.split("\n")
+
+            return report_template, refs_list
+
     class reporting_figure:
         def __init__(
             self,
@@ -379,8 +527,8 @@ class Magazine:
             def wrapper(*args, **kwargs):
 
                 if not Magazine.active:
-                    result = func(*args, **kwargs)
-                    return result
+                    # No bookkeeping at all while reporting is turned off
+                    return func(*args, **kwargs)
 
                 if "show" in kwargs:
                     if kwargs["show"] == True:
@@ -395,3 +543,6 @@ class Magazine:
                 return result
 
             return wrapper
+
+
+atexit.register(Magazine.remove_figure_files)